@@ -1,7 +1,16 @@
-"""Affiliate system blueprint initialization."""
-from flask import Blueprint
+"""Affiliate system blueprint initialization.
 
-affiliate_bp = Blueprint('affiliate', __name__, url_prefix='/affiliate')
+Importing this package is kept cheap: `affiliate_bp` (and with it Flask) is
+only imported on first access, and routes (and through them the services,
+models and SQLAlchemy) and CLI commands are only imported when the blueprint
+is registered on an app. Worker processes that only need the hooks can import
+`affiliate.hooks` directly without pulling in the web layer.
+"""
 
-# Import routes to register them with the blueprint
-from affiliate import routes  # noqa: F401, E402
+
+def __getattr__(name):
+    # PEP 562: `from affiliate import affiliate_bp` imports the blueprint module on demand
+    if name == 'affiliate_bp':
+        from affiliate.blueprint import affiliate_bp
+        return affiliate_bp
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
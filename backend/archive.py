@@ -0,0 +1,200 @@
+"""Affiliate visit archival.
+
+Visits older than `AFFILIATE_ARCHIVE_AFTER_DAYS` are moved out of the
+affiliate_visit table into compact columnar files (see archive_format.py)
+under `AFFILIATE_ARCHIVE_DIR`, partitioned by link and month:
+
+    <AFFILIATE_ARCHIVE_DIR>/link_<affiliate_link_id>/<YYYY>-<MM>.afv
+
+Archival is disabled (and archive reads return nothing) when
+`AFFILIATE_ARCHIVE_DIR` is not set.
+"""
+import fcntl
+import heapq
+import os
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func
+from extensions import db
+from affiliate.models import AffiliateVisit
+from affiliate.transaction import commit
+from affiliate.archive_format import VisitArchiveFile, VisitFileWriter
+from affiliate.partitions import month_start, add_months
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+FILE_SUFFIX = '.afv'
+LOCK_FILE = '.archive.lock'
+
+
+def get_archive_dir():
+    """The configured archive directory, or None if archival is disabled."""
+    return current_app.config.get('AFFILIATE_ARCHIVE_DIR')
+
+
+def partition_path(archive_dir, link_id, visited_at):
+    """Path of the archive file holding a link's visits for one month."""
+    return os.path.join(archive_dir, f"link_{link_id}", f"{visited_at:%Y-%m}{FILE_SUFFIX}")
+
+
+def list_partitions(link_id, archive_dir=None):
+    """All archive files for a link, oldest month first."""
+    archive_dir = archive_dir or get_archive_dir()
+    if not archive_dir:
+        return []
+    link_dir = os.path.join(archive_dir, f"link_{link_id}")
+    if not os.path.isdir(link_dir):
+        return []
+    return [
+        os.path.join(link_dir, name)
+        for name in sorted(os.listdir(link_dir))
+        if name.endswith(FILE_SUFFIX)
+    ]
+
+
+class ArchiveInProgressError(Exception):
+    """Raised when another archive run already holds the archive lock."""
+
+
+@contextmanager
+def _archive_lock(archive_dir):
+    """
+    Hold an exclusive lock on the archive directory for one run.
+
+    Two concurrent runs could otherwise both rewrite the same file, and the
+    loser's rows would be deleted from the database without being archived.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    with open(os.path.join(archive_dir, LOCK_FILE), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ArchiveInProgressError(f"Another archive run holds {archive_dir}/{LOCK_FILE}")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _contains(sorted_ids, visit_id):
+    i = bisect_left(sorted_ids, visit_id)
+    return i < len(sorted_ids) and sorted_ids[i] == visit_id
+
+
+def _archive_link_month(archive_dir, link_id, start, end, batch_size, session):
+    """
+    Archive one link's visits in [start, end) with a single file write, then delete them.
+
+    Rows are streamed oldest first and merged with the existing file's rows,
+    so the file is decoded and written once. A row whose id the file already
+    holds (a previous run wrote the file but failed before deleting) is not
+    written again. Only rows that were just written or are proven to be in
+    the file are deleted.
+
+    Returns the number of visits added to the file.
+    """
+    time_range = (
+        AffiliateVisit.affiliate_link_id == link_id,
+        AffiliateVisit.visited_at >= start,
+        AffiliateVisit.visited_at < end,
+    )
+    rows = session.query(
+        AffiliateVisit.id,
+        AffiliateVisit.visited_at,
+        AffiliateVisit.visitor_ip,
+        AffiliateVisit.user_agent
+    ).filter(*time_range).order_by(AffiliateVisit.visited_at, AffiliateVisit.id).yield_per(batch_size)
+
+    path = partition_path(archive_dir, link_id, start)
+    existing = VisitArchiveFile(path) if os.path.exists(path) else None
+    archived_ids = array('q', sorted(existing.ids())) if existing else array('q')
+
+    # Every row read ends up either newly written or already in the file
+    delete_ids = array('q')
+
+    def new_rows():
+        for row in rows:
+            delete_ids.append(row.id)
+            if not _contains(archived_ids, row.id):
+                yield row.id, row.visited_at, row.visitor_ip, row.user_agent
+
+    writer = VisitFileWriter()
+    try:
+        streams = [existing.rows(), new_rows()] if existing else [new_rows()]
+        for visit in heapq.merge(*streams, key=lambda v: v[1]):
+            writer.add(*visit)
+    finally:
+        if existing:
+            existing.close()
+
+    archived = writer.count - len(archived_ids)
+    if archived:
+        writer.write(path)
+
+    # The file is written before the delete, so a failure never loses visits
+    for i in range(0, len(delete_ids), batch_size):
+        session.query(AffiliateVisit).filter(
+            *time_range,  # Limits the delete to old partitions
+            AffiliateVisit.id.in_(delete_ids[i:i + batch_size].tolist())
+        ).delete(synchronize_session=False)
+    commit(session)
+    return archived
+
+
+def archive_old_visits(older_than_days=None, batch_size=10000, session=None):
+    """
+    Move visits older than N days from the database into the archive.
+
+    Works one link and month at a time, so each archive file is decoded and
+    written at most once per run, streaming rows `batch_size` at a time. Raises ArchiveInProgressError if another
+    run is already going.
+
+    Returns the number of visits archived.
+    """
+    session = session or db.session
+    archive_dir = get_archive_dir()
+    if not archive_dir:
+        return 0
+
+    if older_than_days is None:
+        older_than_days = current_app.config.get('AFFILIATE_ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS)
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    archived = 0
+    with _archive_lock(archive_dir):
+        oldest_by_link = session.query(
+            AffiliateVisit.affiliate_link_id,
+            func.min(AffiliateVisit.visited_at)
+        ).filter(AffiliateVisit.visited_at < cutoff).group_by(AffiliateVisit.affiliate_link_id).all()
+
+        for link_id, oldest in oldest_by_link:
+            start = month_start(oldest)
+            while start < cutoff:
+                end = min(add_months(start, 1), cutoff)
+                archived += _archive_link_month(archive_dir, link_id, start, end, batch_size, session)
+                start = add_months(start, 1)
+
+    return archived
+
+
+def count_archived_visits(link_id, since=None):
+    """Count a link's archived visits, optionally only those at or after `since`."""
+    total = 0
+    for path in list_partitions(link_id):
+        if since is not None and os.path.basename(path) < f"{since:%Y-%m}":
+            continue  # Whole month is before `since`
+        with VisitArchiveFile(path) as archive:
+            if since is None:
+                total += archive.count
+            else:
+                total += archive.count_between(start=since)
+    return total
+
+
+def iter_archived_visits(link_id):
+    """Yield a link's archived visits as (visited_at, visitor_ip, user_agent), oldest first."""
+    for path in list_partitions(link_id):
+        with VisitArchiveFile(path) as archive:
+            yield from archive
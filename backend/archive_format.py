@@ -0,0 +1,279 @@
+"""Compact columnar file format for archived affiliate visits.
+
+One file holds the visits of one affiliate link for one month. Columns are
+stored separately so a scan only touches what it needs:
+
+- header: fixed-size struct (counts, base timestamp/id, section offsets)
+- user agents: dictionary of distinct strings + one small index per visit
+- IPs: 16 bytes per visit (IPv4 stored IPv4-mapped, missing as all zeros)
+- timestamps: varint microsecond deltas from the previous visit (sorted)
+- ids: zigzag varint deltas of AffiliateVisit.id, in visit order, so the
+  archiver can tell exactly which rows a file already holds
+
+Files are read through mmap, so counting visits only touches the header.
+This module has no Flask/SQLAlchemy dependency; see archive.py for the
+pipeline that moves rows out of the database.
+"""
+import mmap
+import os
+import socket
+import struct
+from array import array
+from datetime import datetime, timedelta, timezone
+
+MAGIC = b'AFVA'
+VERSION = 2
+
+# magic, version, flags, count, base_ts_us, base_id, dict_count, ua_offset, ip_offset, ts_offset, id_offset
+HEADER = struct.Struct('<4sHHIqqIIIII')
+
+# Header flag: user agent indexes are uint32 instead of uint16
+FLAG_WIDE_UA_INDEX = 0x1
+
+IP_WIDTH = 16
+_NO_IP = bytes(IP_WIDTH)
+_V4_MAPPED_PREFIX = bytes(10) + b'\xff\xff'
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_us(dt):
+    """Naive UTC datetime -> microseconds since epoch."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_us(us):
+    """Microseconds since epoch -> naive UTC datetime."""
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def pack_ip(ip):
+    """Pack an IP string into 16 bytes; unparseable or missing IPs become zeros."""
+    if not ip:
+        return _NO_IP
+    try:
+        return _V4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip)
+    except OSError:
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    except OSError:
+        return _NO_IP
+
+
+def unpack_ip(packed):
+    """Reverse of pack_ip."""
+    packed = bytes(packed)
+    if packed == _NO_IP:
+        return None
+    if packed.startswith(_V4_MAPPED_PREFIX):
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+class VisitFileWriter:
+    """
+    Build an archive file from visits added in visited_at order.
+
+    Columns are encoded as visits are added, so memory stays close to the
+    size of the finished file rather than one Python tuple per visit.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._dictionary = {}
+        self._ua_indexes = array('I')
+        self._ips = bytearray()
+        self._timestamps = bytearray()
+        self._ids = bytearray()
+        self._base_us = None
+        self._previous_us = None
+        self._base_id = None
+        self._previous_id = None
+
+    def add(self, visit_id, visited_at, visitor_ip, user_agent):
+        """Append one visit; visited_at must not be earlier than the previous visit's."""
+        current_us = _to_us(visited_at)
+        if self._previous_us is None:
+            self._base_us = self._previous_us = current_us
+            self._base_id = self._previous_id = visit_id
+        elif current_us < self._previous_us:
+            raise ValueError("Visits must be added in visited_at order")
+
+        if user_agent is None:
+            self._ua_indexes.append(0)
+        else:
+            self._ua_indexes.append(self._dictionary.setdefault(user_agent, len(self._dictionary) + 1))
+        self._ips += pack_ip(visitor_ip)
+        _encode_varint(current_us - self._previous_us, self._timestamps)
+        delta = visit_id - self._previous_id
+        _encode_varint(delta * 2 if delta >= 0 else -delta * 2 - 1, self._ids)  # zigzag
+        self._previous_us = current_us
+        self._previous_id = visit_id
+        self.count += 1
+
+    def encode(self):
+        """The finished file as bytes."""
+        flags = FLAG_WIDE_UA_INDEX if len(self._dictionary) > 0xFFFF else 0
+        ua_bytes = (self._ua_indexes if flags & FLAG_WIDE_UA_INDEX else array('H', self._ua_indexes)).tobytes()
+
+        dict_bytes = bytearray()
+        for user_agent in self._dictionary:
+            encoded = user_agent.encode('utf-8')
+            _encode_varint(len(encoded), dict_bytes)
+            dict_bytes += encoded
+
+        ua_offset = HEADER.size + len(dict_bytes)
+        ip_offset = ua_offset + len(ua_bytes)
+        ts_offset = ip_offset + len(self._ips)
+        id_offset = ts_offset + len(self._timestamps)
+
+        header = HEADER.pack(
+            MAGIC, VERSION, flags, self.count, self._base_us or 0, self._base_id or 0,
+            len(self._dictionary), ua_offset, ip_offset, ts_offset, id_offset
+        )
+        return b''.join([header, bytes(dict_bytes), ua_bytes, bytes(self._ips), bytes(self._timestamps), bytes(self._ids)])
+
+    def write(self, path):
+        """Atomically write the file (readers never see a partial file)."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def encode_visits(visits):
+    """
+    Encode visits into the archive format.
+
+    Args:
+        visits: Iterable of (visit_id, visited_at, visitor_ip, user_agent) tuples
+
+    Returns:
+        The encoded bytes
+    """
+    writer = VisitFileWriter()
+    for visit in sorted(visits, key=lambda v: v[1]):
+        writer.add(*visit)
+    return writer.encode()
+
+
+def write_visit_file(path, visits):
+    """Atomically write an archive file from (visit_id, visited_at, visitor_ip, user_agent) tuples."""
+    writer = VisitFileWriter()
+    for visit in sorted(visits, key=lambda v: v[1]):
+        writer.add(*visit)
+    writer.write(path)
+
+
+class VisitArchiveFile:
+    """Memory-mapped reader for one archive file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.flags, self.count, self.base_us, self.base_id,
+         self.dict_count, self._ua_offset, self._ip_offset, self._ts_offset,
+         self._id_offset) = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"Not an affiliate visit archive: {path}")
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def user_agent_dictionary(self):
+        """Distinct user agents, in index order (index 1 is the first entry)."""
+        entries = []
+        pos = HEADER.size
+        for _ in range(self.dict_count):
+            length, pos = _decode_varint(self._buf, pos)
+            entries.append(self._buf[pos:pos + length].decode('utf-8'))
+            pos += length
+        return entries
+
+    def user_agent_indexes(self):
+        code = 'I' if self.flags & FLAG_WIDE_UA_INDEX else 'H'
+        return struct.unpack_from('<%d%s' % (self.count, code), self._buf, self._ua_offset)
+
+    def timestamps_us(self):
+        """Visit timestamps as microseconds since epoch, ascending."""
+        pos = self._ts_offset
+        current = self.base_us
+        for _ in range(self.count):
+            delta, pos = _decode_varint(self._buf, pos)
+            current += delta
+            yield current
+
+    def timestamps(self):
+        for us in self.timestamps_us():
+            yield _from_us(us)
+
+    def ips(self):
+        for i in range(self.count):
+            start = self._ip_offset + i * IP_WIDTH
+            yield unpack_ip(self._buf[start:start + IP_WIDTH])
+
+    def ids(self):
+        """AffiliateVisit ids, in visit order."""
+        pos = self._id_offset
+        current = self.base_id
+        for _ in range(self.count):
+            zigzag, pos = _decode_varint(self._buf, pos)
+            current += (zigzag >> 1) if not zigzag & 1 else -((zigzag + 1) >> 1)
+            yield current
+
+    def count_between(self, start=None, end=None):
+        """Count visits with start <= visited_at < end (either bound optional)."""
+        start_us = _to_us(start) if start else None
+        end_us = _to_us(end) if end else None
+        total = 0
+        for us in self.timestamps_us():
+            if end_us is not None and us >= end_us:
+                break
+            if start_us is None or us >= start_us:
+                total += 1
+        return total
+
+    def __iter__(self):
+        """Yield (visited_at, visitor_ip, user_agent) tuples."""
+        dictionary = [None] + self.user_agent_dictionary()
+        indexes = self.user_agent_indexes()
+        for i, (visited_at, ip) in enumerate(zip(self.timestamps(), self.ips())):
+            yield visited_at, ip, dictionary[indexes[i]]
+
+    def rows(self):
+        """Yield (visit_id, visited_at, visitor_ip, user_agent) tuples, oldest first."""
+        for visit_id, (visited_at, ip, user_agent) in zip(self.ids(), self):
+            yield visit_id, visited_at, ip, user_agent
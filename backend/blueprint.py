@@ -0,0 +1,14 @@
+"""Affiliate system blueprint definition."""
+from flask import Blueprint
+
+
+class AffiliateBlueprint(Blueprint):
+    """Blueprint that imports its routes and commands on first registration."""
+
+    def register(self, app, options):
+        # Import routes and CLI commands to register them with the blueprint
+        from affiliate import routes, commands  # noqa: F401
+        super().register(app, options)
+
+
+affiliate_bp = AffiliateBlueprint('affiliate', 'affiliate', url_prefix='/affiliate')
@@ -0,0 +1,47 @@
+"""Affiliate system maintenance commands (run as `flask affiliate <command>`)."""
+import click
+from flask import current_app
+from affiliate import affiliate_bp
+from affiliate.archive import ArchiveInProgressError, archive_old_visits, get_archive_dir
+from affiliate.ledger import backfill_ledger
+from affiliate.partitions import DEFAULT_MONTHS_AHEAD, ensure_partitions, drop_archived_visit_partitions
+
+
+@affiliate_bp.cli.command('archive-visits')
+@click.option('--older-than-days', type=int, default=None,
+              help='Archive visits older than this (default: AFFILIATE_ARCHIVE_AFTER_DAYS or 90).')
+@click.option('--batch-size', type=int, default=10000, show_default=True,
+              help='Visits fetched per round trip and deleted per DELETE statement.')
+def archive_visits_command(older_than_days, batch_size):
+    """Move old affiliate visits into the columnar archive."""
+    if not get_archive_dir():
+        raise click.ClickException('AFFILIATE_ARCHIVE_DIR is not configured')
+    
+    try:
+        archived = archive_old_visits(older_than_days, batch_size=batch_size)
+    except ArchiveInProgressError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"[Affiliate] Archived {archived} visits")
+
+
+@affiliate_bp.cli.command('maintain-partitions')
+@click.option('--months-ahead', type=int, default=DEFAULT_MONTHS_AHEAD, show_default=True,
+              help='Create partitions up to this many months in the future.')
+def maintain_partitions_command(months_ahead):
+    """Create upcoming monthly partitions and drop archived visit partitions past retention."""
+    created = ensure_partitions(months_ahead)
+    click.echo(f"[Affiliate] Created {len(created)} partitions: {', '.join(created) or '-'}")
+    
+    keep_months = current_app.config.get('AFFILIATE_VISIT_RETENTION_MONTHS')
+    if keep_months is None:
+        return
+    dropped, kept, busy = drop_archived_visit_partitions(keep_months)
+    click.echo(f"[Affiliate] affiliate_visit: dropped {len(dropped)} archived partitions, "
+               f"kept {len(kept)} that still hold visits, skipped {len(busy)} (table busy)")
+
+
+@affiliate_bp.cli.command('backfill-ledger')
+def backfill_ledger_command():
+    """Add ledger entries for rewards recorded before the ledger existed."""
+    appended = backfill_ledger()
+    click.echo(f"[Affiliate] Appended {appended} ledger entries")
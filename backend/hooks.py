@@ -4,7 +4,12 @@ These functions should be called from existing code at appropriate points:
 - on_user_registered: After a new user is created (before email verification)
 - on_email_verified: After a user verifies their email
 - on_payment_success: After a successful payment
+
+Hooks run inside the caller's transaction: they flush their changes but never
+commit, so the host's own work isn't committed early. Commit (or roll back)
+after calling them as part of the host's normal flow.
 """
+from affiliate.transaction import joined_transaction
 from affiliate.services import (
     match_registration_to_affiliate,
     create_referral,
@@ -13,7 +18,7 @@ from affiliate.services import (
 )
 
 
-def on_user_registered(user_id, user_email, affiliate_code=None):
+def on_user_registered(user_id, user_email, affiliate_code=None, session=None):
     """
     Called when a new user registers.
     Checks if they came from an affiliate link or match an email list.
@@ -23,26 +28,28 @@ def on_user_registered(user_id, user_email, affiliate_code=None):
         user_id: The newly registered user's ID
         user_email: The newly registered user's email
         affiliate_code: The affiliate code from URL query param (if any)
+        session: The host's session (defaults to db.session)
     
     Returns:
         (sharer_id, source) if matched, (None, None) otherwise
     """
-    sharer_id, source = match_registration_to_affiliate(user_email, affiliate_code)
-    
-    if sharer_id:
-        # Don't let users refer themselves
-        if sharer_id == user_id:
-            print(f"[Affiliate] Ignoring self-referral for user {user_id}")
-            return None, None
+    with joined_transaction(session) as session:
+        sharer_id, source = match_registration_to_affiliate(user_email, affiliate_code, session=session)
         
-        referral = create_referral(sharer_id, user_id, source)
-        print(f"[Affiliate] Created referral: sharer={sharer_id}, referred={user_id}, source={source}")
-        return sharer_id, source
+        if sharer_id:
+            # Don't let users refer themselves
+            if sharer_id == user_id:
+                print(f"[Affiliate] Ignoring self-referral for user {user_id}")
+                return None, None
+            
+            referral = create_referral(sharer_id, user_id, source, session=session)
+            print(f"[Affiliate] Created referral: sharer={sharer_id}, referred={user_id}, source={source}")
+            return sharer_id, source
     
     return None, None
 
 
-def on_email_verified(user_id):
+def on_email_verified(user_id, session=None):
     """
     Called when a user verifies their email.
     Awards rewards to the sharer if this user was referred:
@@ -51,11 +58,13 @@ def on_email_verified(user_id):
     
     Args:
         user_id: The user who just verified their email
+        session: The host's session (defaults to db.session)
     
     Returns:
         (success, reward_type, message)
     """
-    success, reward_type, message = process_email_verified_reward(user_id)
+    with joined_transaction(session) as session:
+        success, reward_type, message = process_email_verified_reward(user_id, session=session)
     
     if success:
         print(f"[Affiliate] Email verified reward processed for referred user {user_id}: {reward_type}")
@@ -63,7 +72,7 @@ def on_email_verified(user_id):
     return success, reward_type, message
 
 
-def on_payment_success(user_id, plan_type):
+def on_payment_success(user_id, plan_type, session=None):
     """
     Called when a user makes a successful purchase.
     Awards VIP upgrade to the sharer if this user was referred.
@@ -71,6 +80,7 @@ def on_payment_success(user_id, plan_type):
     Args:
         user_id: The user who made the purchase
         plan_type: 'daypass', 'pro', or 'vip'
+        session: The host's session (defaults to db.session)
     
     Returns:
         (success, message)
@@ -78,7 +88,8 @@ def on_payment_success(user_id, plan_type):
     if plan_type not in ['daypass', 'pro', 'vip']:
         return False, f"Invalid plan type: {plan_type}"
     
-    success, message = process_purchase_reward(user_id, plan_type)
+    with joined_transaction(session) as session:
+        success, message = process_purchase_reward(user_id, plan_type, session=session)
     
     if success:
         print(f"[Affiliate] Purchase reward processed for referred user {user_id}: {message}")
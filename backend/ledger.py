@@ -0,0 +1,189 @@
+"""Affiliate reward ledger.
+
+Every reward appends an immutable entry to the sharer's ledger with the next
+per-user sequence number. Every SNAPSHOT_INTERVAL entries a balance snapshot
+is written, so a balance read is the latest snapshot plus at most
+SNAPSHOT_INTERVAL tail entries, no matter how long the ledger grows.
+"""
+from sqlalchemy import event, func
+from extensions import db
+from models import User
+from affiliate.models import AffiliateLedgerEntry, AffiliateBalanceSnapshot, AffiliateReward
+from affiliate.transaction import commit
+
+# Maximum number of entries read past the latest snapshot on a balance query
+SNAPSHOT_INTERVAL = 100
+
+
+class LedgerImmutableError(Exception):
+    """Raised when code tries to modify or delete a ledger entry."""
+
+
+@event.listens_for(AffiliateLedgerEntry, 'before_update')
+def _reject_update(mapper, connection, target):
+    raise LedgerImmutableError(f"Ledger entries are append-only: {target!r}")
+
+
+@event.listens_for(AffiliateLedgerEntry, 'before_delete')
+def _reject_delete(mapper, connection, target):
+    raise LedgerImmutableError(f"Ledger entries are append-only: {target!r}")
+
+
+def _latest_snapshot(user_id, session):
+    return session.query(AffiliateBalanceSnapshot).filter_by(user_id=user_id).order_by(
+        AffiliateBalanceSnapshot.sequence.desc()
+    ).first()
+
+
+def _last_sequence(user_id, session):
+    last = session.query(func.max(AffiliateLedgerEntry.sequence)).filter_by(user_id=user_id).scalar()
+    return last or 0
+
+
+def _tail_sum(user_id, after_sequence, session):
+    total = session.query(func.coalesce(func.sum(AffiliateLedgerEntry.tokens), 0)).filter(
+        AffiliateLedgerEntry.user_id == user_id,
+        AffiliateLedgerEntry.sequence > after_sequence
+    ).scalar()
+    return int(total or 0)
+
+
+def get_balance(user_id, session=None):
+    """Get a user's current token total: latest snapshot + tail entries."""
+    session = session or db.session
+    snapshot = _latest_snapshot(user_id, session)
+    if snapshot:
+        return snapshot.balance + _tail_sum(user_id, snapshot.sequence, session)
+    return _tail_sum(user_id, 0, session)
+
+
+def append_entry(user_id, entry_type, tokens, reward_id=None, session=None):
+    """
+    Append an entry to a user's ledger, snapshotting the balance when due.
+
+    The entry is flushed but not committed; the caller's commit covers it.
+    A concurrent append for the same user fails on the (user_id, sequence)
+    unique constraint rather than leaving a gap or duplicate.
+
+    Returns the new AffiliateLedgerEntry.
+    """
+    session = session or db.session
+    entry = AffiliateLedgerEntry(
+        user_id=user_id,
+        sequence=_last_sequence(user_id, session) + 1,
+        entry_type=entry_type,
+        tokens=tokens,
+        reward_id=reward_id
+    )
+    session.add(entry)
+    session.flush()
+
+    snapshot = _latest_snapshot(user_id, session)
+    snapshot_sequence = snapshot.sequence if snapshot else 0
+    if entry.sequence - snapshot_sequence >= SNAPSHOT_INTERVAL:
+        base = snapshot.balance if snapshot else 0
+        session.add(AffiliateBalanceSnapshot(
+            user_id=user_id,
+            sequence=entry.sequence,
+            balance=base + _tail_sum(user_id, snapshot_sequence, session)
+        ))
+        session.flush()
+
+    return entry
+
+
+def record_reward(reward, session=None):
+    """Append the ledger entry for a newly created AffiliateReward."""
+    session = session or db.session
+    if reward.id is None:
+        session.flush()
+    return append_entry(
+        reward.user_id,
+        reward.reward_type,
+        reward.tokens_awarded or 0,
+        reward_id=reward.id,
+        session=session
+    )
+
+
+def backfill_ledger(session=None):
+    """
+    Append ledger entries for rewards that don't have one yet.
+
+    Databases set up with db.create_all() instead of schema.sql (whose
+    section 22 does this in SQL) otherwise start with empty ledgers. Safe to
+    rerun: rewards already in the ledger are skipped. Each user's rewards are
+    appended oldest first, with the user row locked like a live reward.
+
+    Returns the number of entries appended.
+    """
+    session = session or db.session
+    in_ledger = session.query(AffiliateLedgerEntry.id).filter(
+        AffiliateLedgerEntry.reward_id == AffiliateReward.id
+    ).exists()
+    user_ids = [
+        user_id for (user_id,) in
+        session.query(AffiliateReward.user_id).filter(~in_ledger).distinct().order_by(AffiliateReward.user_id)
+    ]
+
+    appended = 0
+    for user_id in user_ids:
+        session.query(User).filter_by(id=user_id).with_for_update().first()
+        rewards = session.query(AffiliateReward).filter(
+            AffiliateReward.user_id == user_id,
+            ~in_ledger
+        ).order_by(AffiliateReward.created_at, AffiliateReward.id).all()
+        for reward in rewards:
+            record_reward(reward, session=session)
+        appended += len(rewards)
+        commit(session)
+
+    return appended
+
+
+def verify_ledger(user_id, session=None):
+    """
+    Replay a user's ledger from the start and check its integrity.
+
+    Checks that sequences run 1..n without gaps, that every snapshot matches
+    the replayed balance at its sequence, and that the snapshot-based balance
+    matches the full replay.
+
+    Returns (ok, problems) where problems is a list of messages.
+    """
+    session = session or db.session
+    problems = []
+
+    snapshots = {
+        s.sequence: s.balance
+        for s in session.query(AffiliateBalanceSnapshot).filter_by(user_id=user_id)
+    }
+
+    entries = session.query(
+        AffiliateLedgerEntry.sequence,
+        AffiliateLedgerEntry.tokens
+    ).filter_by(user_id=user_id).order_by(AffiliateLedgerEntry.sequence).yield_per(1000)
+
+    expected_sequence = 1
+    balance = 0
+    for sequence, tokens in entries:
+        if sequence != expected_sequence:
+            problems.append(f"Sequence gap: expected {expected_sequence}, found {sequence}")
+        expected_sequence = sequence + 1
+        balance += tokens
+
+        if sequence in snapshots:
+            snapshot_balance = snapshots.pop(sequence)
+            if snapshot_balance != balance:
+                problems.append(
+                    f"Snapshot at sequence {sequence} has balance {snapshot_balance}, replay gives {balance}"
+                )
+
+    for sequence in sorted(snapshots):
+        problems.append(f"Snapshot at sequence {sequence} has no matching ledger entry")
+
+    current = get_balance(user_id, session=session)
+    if current != balance:
+        problems.append(f"Snapshot balance {current} does not match replayed balance {balance}")
+
+    return not problems, problems
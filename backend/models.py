@@ -1,8 +1,30 @@
 """Affiliate system database models."""
 from datetime import datetime
+from sqlalchemy import DDL, event
 from extensions import db
 
 
+def _unless_postgresql(ddl, target, bind, **kw):
+    """ddl_if() check: emit the DDL on every database except PostgreSQL."""
+    return kw['dialect'].name != 'postgresql'
+
+
+def _partition_on_postgresql(table, key):
+    """
+    Finish a monthly-partitioned table after db.create_all() on PostgreSQL.
+
+    The primary key there must include the partition key, so (id, key)
+    replaces the plain id key used on other databases. A DEFAULT partition
+    catches rows for months that `flask affiliate maintain-partitions` hasn't
+    created yet, so inserts never fail when maintenance falls behind.
+    """
+    for statement in (
+        f"ALTER TABLE {table.name} ADD PRIMARY KEY (id, {key})",
+        f"CREATE TABLE IF NOT EXISTS {table.name}_default PARTITION OF {table.name} DEFAULT",
+    ):
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
 class AffiliateLink(db.Model):
     """Stores unique affiliate code per user."""
     __tablename__ = 'affiliate_link'
@@ -20,19 +42,30 @@ class AffiliateLink(db.Model):
 
 
 class AffiliateVisit(db.Model):
-    """Tracks visitors from affiliate links."""
+    """Tracks visitors from affiliate links. Partitioned by month on visited_at."""
     __tablename__ = 'affiliate_visit'
     
+    # On PostgreSQL the primary key is (id, visited_at), see _partition_on_postgresql
     id = db.Column(db.Integer, primary_key=True)
     affiliate_link_id = db.Column(db.Integer, db.ForeignKey('affiliate_link.id'), nullable=False)
     visitor_ip = db.Column(db.String(45), nullable=True)  # IPv6 compatible
     user_agent = db.Column(db.String(512), nullable=True)
-    visited_at = db.Column(db.DateTime, default=datetime.utcnow)
+    visited_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.PrimaryKeyConstraint('id').ddl_if(callable_=_unless_postgresql),
+        db.Index('ix_affiliate_visit_link_visited', 'affiliate_link_id', 'visited_at'),
+        db.Index('ix_affiliate_visit_link_ip_visited', 'affiliate_link_id', 'visitor_ip', 'visited_at'),
+        {'postgresql_partition_by': 'RANGE (visited_at)'},
+    )
     
     def __repr__(self):
         return f'<AffiliateVisit {self.id}>'
 
 
+_partition_on_postgresql(AffiliateVisit.__table__, 'visited_at')
+
+
 class AffiliateEmailList(db.Model):
     """Stores marketing emails entered by user for affiliate invitations."""
     __tablename__ = 'affiliate_email_list'
@@ -83,5 +116,50 @@ class AffiliateReward(db.Model):
     referral_id = db.Column(db.Integer, db.ForeignKey('affiliate_referral.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Rewards are read by user or referral, never by time range, so the table
+    # isn't partitioned; these indexes serve those lookups directly
+    __table_args__ = (
+        db.Index('ix_affiliate_reward_user_created', 'user_id', 'created_at'),
+        db.Index('ix_affiliate_reward_referral_created', 'referral_id', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<AffiliateReward {self.reward_type} for user {self.user_id}>'
+
+
+class AffiliateLedgerEntry(db.Model):
+    """Append-only ledger of token movements, one gap-free sequence per user."""
+    __tablename__ = 'affiliate_ledger_entry'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    sequence = db.Column(db.Integer, nullable=False)  # 1, 2, 3... per user
+    entry_type = db.Column(db.String(30), nullable=False)  # Mirrors AffiliateReward.reward_type
+    tokens = db.Column(db.Integer, nullable=False, default=0)  # Signed token delta
+    reward_id = db.Column(db.Integer, db.ForeignKey('affiliate_reward.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'sequence', name='uix_affiliate_ledger_user_seq'),
+    )
+    
+    def __repr__(self):
+        return f'<AffiliateLedgerEntry user={self.user_id} seq={self.sequence} tokens={self.tokens}>'
+
+
+class AffiliateBalanceSnapshot(db.Model):
+    """Periodic per-user balance, covering all ledger entries up to `sequence`."""
+    __tablename__ = 'affiliate_balance_snapshot'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    sequence = db.Column(db.Integer, nullable=False)  # Last ledger entry included
+    balance = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'sequence', name='uix_affiliate_snapshot_user_seq'),
+    )
+    
+    def __repr__(self):
+        return f'<AffiliateBalanceSnapshot user={self.user_id} seq={self.sequence} balance={self.balance}>'
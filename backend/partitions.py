@@ -0,0 +1,187 @@
+"""Monthly range partitions for affiliate_visit.
+
+The table is partitioned by month on visited_at (PostgreSQL declarative
+partitioning), so archived months can be dropped as whole tables instead
+of deleted row by row. It doesn't make the indexed visit lookups faster
+(see benchmarks/results/partitioned_visits.txt). Partitions are named
+`<table>_<YYYY>_<MM>`.
+
+It also has a DEFAULT partition (`<table>_default`) so inserts never
+fail. Run `flask affiliate maintain-partitions` regularly (e.g. daily) so
+future months exist before rows arrive for them; rows that did land in the
+default partition are moved out when their month's partition is created.
+"""
+import re
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from extensions import db
+from affiliate.transaction import commit
+
+# Partitioned table -> partition key column
+PARTITIONED_TABLES = {
+    'affiliate_visit': 'visited_at',
+}
+
+DEFAULT_MONTHS_AHEAD = 3
+
+# How long dropping a partition may wait for its lock on affiliate_visit
+DROP_LOCK_TIMEOUT = '2s'
+
+# SQLSTATE raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+
+_PARTITION_SUFFIX = re.compile(r'_(\d{4})_(\d{2})$')
+
+
+def month_start(dt):
+    """First instant of dt's month."""
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    """Shift a month start by a number of months (may be negative)."""
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, start):
+    return f"{table}_{start:%Y_%m}"
+
+
+def list_partitions(table, session=None):
+    """Attached partitions of a table as {name: month_start}, oldest first."""
+    session = session or db.session
+    rows = session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = :table"
+    ), {'table': table}).scalars()
+
+    partitions = {}
+    for name in rows:
+        match = _PARTITION_SUFFIX.search(name)
+        if match:
+            partitions[name] = datetime(int(match.group(1)), int(match.group(2)), 1)
+    return dict(sorted(partitions.items(), key=lambda item: item[1]))
+
+
+def _create_partition(table, name, start, session):
+    """
+    Create one monthly partition.
+
+    Rows that already landed in the DEFAULT partition for that month (because
+    maintenance fell behind) are moved into the new partition first, since
+    PostgreSQL refuses to add a partition that the default's rows overlap.
+    """
+    key = PARTITIONED_TABLES[table]
+    default = f"{table}_default"
+    bounds = f"FROM ('{start:%Y-%m-%d}') TO ('{add_months(start, 1):%Y-%m-%d}')"
+    in_range = f"{key} >= '{start:%Y-%m-%d}' AND {key} < '{add_months(start, 1):%Y-%m-%d}'"
+
+    has_default = session.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': default}).scalar()
+    if has_default and session.execute(text(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_range})")).scalar():
+        session.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        session.execute(text(
+            f"WITH moved AS (DELETE FROM {default} WHERE {in_range} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ))
+        session.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds}"))
+    else:
+        session.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES {bounds}"))
+
+
+def _months_in_default(table, session):
+    """Month starts of the rows currently in the table's DEFAULT partition."""
+    default = f"{table}_default"
+    if not session.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': default}).scalar():
+        return set()
+    rows = session.execute(text(
+        f"SELECT DISTINCT date_trunc('month', {PARTITIONED_TABLES[table]}) FROM {default}"
+    )).scalars()
+    return {month_start(month) for month in rows}
+
+
+def ensure_partitions(months_ahead=DEFAULT_MONTHS_AHEAD, now=None, session=None):
+    """
+    Create any missing partitions from the current month to `months_ahead` months out.
+
+    Months that have rows sitting in the DEFAULT partition get their
+    partition too, so the default partition ends up empty.
+
+    Returns the names of the partitions created.
+    """
+    session = session or db.session
+    current = month_start(now or datetime.utcnow())
+
+    created = []
+    for table in PARTITIONED_TABLES:
+        existing = list_partitions(table, session=session)
+        months = {add_months(current, offset) for offset in range(months_ahead + 1)}
+        months.update(_months_in_default(table, session))
+        for start in sorted(months):
+            name = partition_name(table, start)
+            if name not in existing:
+                _create_partition(table, name, start, session)
+                created.append(name)
+
+    commit(session)
+    return created
+
+
+def drop_archived_visit_partitions(keep_months, now=None, lock_timeout=DROP_LOCK_TIMEOUT, session=None):
+    """
+    Drop affiliate_visit partitions that end more than `keep_months` months ago
+    and are empty because `flask affiliate archive-visits` moved their rows out.
+
+    Partitions still holding rows are left attached, so visits are never lost.
+    Dropping a partition needs an ACCESS EXCLUSIVE lock on affiliate_visit
+    itself. It is taken on the parent before touching the partition, the
+    same order queries on affiliate_visit lock in, so the two can't
+    deadlock. If the lock isn't granted within `lock_timeout`, the partition
+    is skipped until the next run rather than stalling visit traffic.
+
+    Returns (dropped, kept, busy) lists of partition names.
+    """
+    session = session or db.session
+    cutoff = add_months(month_start(now or datetime.utcnow()), -keep_months)
+
+    kept = []
+    empty = []
+    for name, start in list_partitions('affiliate_visit', session=session).items():
+        if add_months(start, 1) > cutoff:
+            continue
+        (kept if _has_rows(name, session) else empty).append(name)
+    # End the read so no partition lock is held when the parent is locked
+    session.rollback()
+
+    dropped = []
+    busy = []
+    for name in empty:
+        try:
+            session.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+            session.execute(text("LOCK TABLE affiliate_visit IN ACCESS EXCLUSIVE MODE"))
+            if _has_rows(name, session):
+                kept.append(name)
+            else:
+                session.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+            commit(session)
+        except OperationalError as e:
+            session.rollback()
+            if _sqlstate(e) != LOCK_NOT_AVAILABLE:
+                raise
+            print(f"[Affiliate] Skipped {name}: affiliate_visit is busy, retry on the next run")
+            busy.append(name)
+
+    return dropped, kept, busy
+
+
+def _has_rows(table, session):
+    return session.execute(text(f"SELECT EXISTS (SELECT 1 FROM {table})")).scalar()
+
+
+def _sqlstate(error):
+    """SQLSTATE of a DBAPI error (psycopg2 calls it pgcode, psycopg 3 sqlstate)."""
+    return getattr(error.orig, 'pgcode', None) or getattr(error.orig, 'sqlstate', None)
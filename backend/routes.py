@@ -1,8 +1,10 @@
 """Affiliate system API routes."""
-from flask import request, jsonify, g
+import hmac
+from flask import request, jsonify, g, current_app, Response
 from urllib.parse import unquote
 from affiliate import affiliate_bp
 from affiliate.models import AffiliateEmailList
+from affiliate.transaction import unit_of_work, read_only_session, instrument_all_engines, render_prometheus_metrics
 from affiliate.services import (
     get_or_create_affiliate_link,
     track_affiliate_visit,
@@ -17,19 +19,40 @@ from affiliate.services import (
 from utils import token_required
 
 
+@affiliate_bp.before_app_request
+def instrument_connection_pools():
+    """Attach pool metrics before any handler (e.g. token_required) checks out a connection."""
+    instrument_all_engines()
+
+
+@affiliate_bp.route('/metrics', methods=['GET'])
+def export_pool_metrics():
+    """Export pool metrics for Prometheus (only when AFFILIATE_METRICS_TOKEN is set)."""
+    token = current_app.config.get('AFFILIATE_METRICS_TOKEN')
+    if not token:
+        return jsonify({'message': 'Not found'}), 404
+    
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return jsonify({'message': 'Invalid metrics token'}), 401
+    
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @affiliate_bp.route('/link', methods=['GET'])
 @token_required
 def get_affiliate_link():
     """Get the current user's affiliate link."""
     user = g.user
-    link = get_or_create_affiliate_link(user.id)
+    with unit_of_work() as session:
+        link = get_or_create_affiliate_link(user.id, session=session)
+        code = link.code
     
-    from flask import current_app
     domain = current_app.config.get('DOMAIN', 'http://localhost:5000')
-    full_url = f"{domain}/?ref={link.code}"
+    full_url = f"{domain}/?ref={code}"
     
     return jsonify({
-        'code': link.code,
+        'code': code,
         'url': full_url
     }), 200
 
@@ -46,7 +69,8 @@ def track_visit():
     visitor_ip = request.remote_addr
     user_agent = request.headers.get('User-Agent', '')
     
-    link = track_affiliate_visit(code, visitor_ip, user_agent)
+    with unit_of_work() as session:
+        link = track_affiliate_visit(code, visitor_ip, user_agent, session=session)
     
     if link:
         return jsonify({'message': 'Visit tracked', 'valid': True}), 200
@@ -59,17 +83,18 @@ def track_visit():
 def list_marketing_emails():
     """Get user's marketing email list."""
     user = g.user
-    emails = get_marketing_emails(user.id)
-    
-    return jsonify({
-        'emails': [
+    with read_only_session() as session:
+        emails = [
             {
                 'email': e.email,
                 'sent_at': e.sent_at.isoformat() if e.sent_at else None,
                 'created_at': e.created_at.isoformat() if e.created_at else None
             }
-            for e in emails
+            for e in get_marketing_emails(user.id, session=session)
         ]
+    
+    return jsonify({
+        'emails': emails
     }), 200
 
 
@@ -93,9 +118,10 @@ def add_email():
         return jsonify({'message': 'At least one email is required'}), 400
     
     results = []
-    for email in emails:
-        success, msg = add_marketing_email(user.id, email)
-        results.append({'email': email, 'success': success, 'message': msg})
+    with unit_of_work() as session:
+        for email in emails:
+            success, msg = add_marketing_email(user.id, email, session=session)
+            results.append({'email': email, 'success': success, 'message': msg})
     
     all_success = all(r['success'] for r in results)
     
@@ -113,7 +139,8 @@ def delete_email(email):
     print(f"DEBUG: Affiliate delete_email called for: {email}")
     user = g.user
     
-    success = remove_marketing_email(user.id, email)
+    with unit_of_work() as session:
+        success = remove_marketing_email(user.id, email, session=session)
     
     if success:
         return jsonify({'message': 'Email removed'}), 200
@@ -127,11 +154,11 @@ def send_emails():
     """Send marketing emails to all addresses in user's list."""
     user = g.user
     
-    emails = get_marketing_emails(user.id)
-    if not emails:
-        return jsonify({'message': 'No emails in your list'}), 400
-    
+    # Sending runs outside any request-wide transaction (one HTTP call per
+    # address), so read what we need from g.user before it gets expired
     results = send_all_marketing_emails(user.id, user.name)
+    if not results:
+        return jsonify({'message': 'No emails in your list'}), 400
     
     sent_count = sum(1 for r in results if r['success'])
     
@@ -166,19 +193,20 @@ def get_dashboard():
     """Get affiliate dashboard statistics."""
     user = g.user
     
-    stats = get_affiliate_stats(user.id)
-    history = get_referral_history(user.id)
+    with read_only_session() as session:
+        stats = get_affiliate_stats(user.id, session=session)
+        history = get_referral_history(user.id, session=session)
     
     # Build full affiliate URL
-    from flask import current_app
     domain = current_app.config.get('DOMAIN', 'http://localhost:5000')
     if stats['affiliate_code']:
         stats['affiliate_url'] = f"{domain}/?ref={stats['affiliate_code']}"
     else:
         # Generate link if not exists
-        link = get_or_create_affiliate_link(user.id)
-        stats['affiliate_code'] = link.code
-        stats['affiliate_url'] = f"{domain}/?ref={link.code}"
+        with unit_of_work() as session:
+            link = get_or_create_affiliate_link(user.id, session=session)
+            stats['affiliate_code'] = link.code
+        stats['affiliate_url'] = f"{domain}/?ref={stats['affiliate_code']}"
     
     return jsonify({
         'stats': stats,
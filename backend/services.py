@@ -2,7 +2,12 @@
 import secrets
 import string
 from datetime import datetime, timedelta
+from flask import current_app
 from extensions import db
+from models import User
+from affiliate.transaction import commit, unit_of_work, read_only_session
+from affiliate.ledger import record_reward, get_balance
+from affiliate.archive import count_archived_visits
 from affiliate.models import (
     AffiliateLink, 
     AffiliateVisit, 
@@ -12,34 +17,50 @@ from affiliate.models import (
 )
 
 
-def generate_affiliate_code(length=8):
+# resend is only needed when sending email, so it's imported on first use
+_resend = None
+
+
+def _get_resend():
+    """Import the resend SDK once, on first use."""
+    global _resend
+    if _resend is None:
+        import resend
+        _resend = resend
+    return _resend
+
+
+def generate_affiliate_code(length=8, session=None):
     """Generate a unique affiliate code."""
+    session = session or db.session
     alphabet = string.ascii_uppercase + string.digits
     while True:
         code = ''.join(secrets.choice(alphabet) for _ in range(length))
         # Check if code already exists
-        if not AffiliateLink.query.filter_by(code=code).first():
+        if not session.query(AffiliateLink).filter_by(code=code).first():
             return code
 
 
-def get_or_create_affiliate_link(user_id):
+def get_or_create_affiliate_link(user_id, session=None):
     """Get existing or create new affiliate link for user."""
-    link = AffiliateLink.query.filter_by(user_id=user_id).first()
+    session = session or db.session
+    link = session.query(AffiliateLink).filter_by(user_id=user_id).first()
     if not link:
-        code = generate_affiliate_code()
+        code = generate_affiliate_code(session=session)
         link = AffiliateLink(user_id=user_id, code=code)
-        db.session.add(link)
-        db.session.commit()
+        session.add(link)
+        commit(session)
     return link
 
 
-def track_affiliate_visit(code, visitor_ip=None, user_agent=None):
+def track_affiliate_visit(code, visitor_ip=None, user_agent=None, session=None):
     """Record a visit from an affiliate link. Returns the link if found."""
-    link = AffiliateLink.query.filter_by(code=code).first()
+    session = session or db.session
+    link = session.query(AffiliateLink).filter_by(code=code).first()
     if link:
         # Check for duplicate visit from same IP within last 30 seconds
         if visitor_ip:
-            recent_visit = AffiliateVisit.query.filter_by(
+            recent_visit = session.query(AffiliateVisit).filter_by(
                 affiliate_link_id=link.id,
                 visitor_ip=visitor_ip
             ).filter(AffiliateVisit.visited_at > datetime.utcnow() - timedelta(seconds=30)).first()
@@ -52,61 +73,87 @@ def track_affiliate_visit(code, visitor_ip=None, user_agent=None):
             visitor_ip=visitor_ip,
             user_agent=user_agent[:512] if user_agent else None
         )
-        db.session.add(visit)
-        db.session.commit()
+        session.add(visit)
+        commit(session)
         return link
     return None
 
 
-def add_marketing_email(user_id, email):
+def count_link_visits(link_id, since=None, session=None):
+    """Count a link's visits across hot database rows and the archive."""
+    session = session or db.session
+    query = session.query(AffiliateVisit).filter_by(affiliate_link_id=link_id)
+    if since is not None:
+        query = query.filter(AffiliateVisit.visited_at >= since)
+    return query.count() + count_archived_visits(link_id, since=since)
+
+
+def add_marketing_email(user_id, email, session=None):
     """Add an email to user's marketing list. Returns (success, message)."""
+    session = session or db.session
     email = email.lower().strip()
     
     # Check if already exists
-    existing = AffiliateEmailList.query.filter_by(user_id=user_id, email=email).first()
+    existing = session.query(AffiliateEmailList).filter_by(user_id=user_id, email=email).first()
     if existing:
         return False, "Email already in your list"
     
     # Check if this email belongs to the user themselves
-    from models import User
-    user = User.query.get(user_id)
+    user = session.get(User, user_id)
     if user and user.email.lower() == email:
         return False, "You cannot add your own email"
     
     entry = AffiliateEmailList(user_id=user_id, email=email)
-    db.session.add(entry)
-    db.session.commit()
+    session.add(entry)
+    commit(session)
     return True, "Email added successfully"
 
 
-def remove_marketing_email(user_id, email):
+def remove_marketing_email(user_id, email, session=None):
     """Remove an email from user's marketing list."""
+    session = session or db.session
     email = email.lower().strip()
-    entry = AffiliateEmailList.query.filter_by(user_id=user_id, email=email).first()
+    entry = session.query(AffiliateEmailList).filter_by(user_id=user_id, email=email).first()
     if entry:
-        db.session.delete(entry)
-        db.session.commit()
+        session.delete(entry)
+        commit(session)
         return True
     return False
 
 
-def get_marketing_emails(user_id):
+def get_marketing_emails(user_id, session=None):
     """Get all marketing emails for a user."""
-    return AffiliateEmailList.query.filter_by(user_id=user_id).all()
+    session = session or db.session
+    return session.query(AffiliateEmailList).filter_by(user_id=user_id).all()
+
+
+def mark_marketing_email_sent(user_id, email, session=None):
+    """Record when a marketing email was sent to an address in the user's list."""
+    session = session or db.session
+    entry = session.query(AffiliateEmailList).filter_by(user_id=user_id, email=email.lower()).first()
+    if entry:
+        entry.sent_at = datetime.utcnow()
+        commit(session)
 
 
-def send_marketing_email_to_address(user_id, recipient_email, sender_name):
-    """Send predefined marketing email to a single address."""
-    from flask import current_app
-    import resend
+def send_marketing_email_to_address(user_id, recipient_email, sender_name, affiliate_code=None, session=None):
+    """
+    Send predefined marketing email to a single address.
     
+    No transaction is held open during the call to Resend: the affiliate link
+    is looked up (unless `affiliate_code` is given) and sent_at is recorded in
+    separate short units of work.
+    """
     try:
+        resend = _get_resend()
         resend.api_key = current_app.config['RESEND_API_KEY']
         domain = current_app.config['DOMAIN']
         
         # Get user's affiliate link
-        link = get_or_create_affiliate_link(user_id)
-        affiliate_url = f"{domain}/?ref={link.code}"
+        if affiliate_code is None:
+            with unit_of_work(session) as scope:
+                affiliate_code = get_or_create_affiliate_link(user_id, session=scope).code
+        affiliate_url = f"{domain}/?ref={affiliate_code}"
         
         content = f"""
         <div style="font-family: 'Segoe UI', system-ui, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
@@ -137,56 +184,72 @@ def send_marketing_email_to_address(user_id, recipient_email, sender_name):
         }
         
         resend.Emails.send(params)
-        
-        # Update sent_at timestamp
-        entry = AffiliateEmailList.query.filter_by(user_id=user_id, email=recipient_email.lower()).first()
-        if entry:
-            entry.sent_at = datetime.utcnow()
-            db.session.commit()
-        
-        return True, "Email sent successfully"
     except Exception as e:
         print(f"[Affiliate] Error sending email: {e}")
         return False, str(e)
+    
+    # The email is out at this point; failing to record it must not report a failed send
+    try:
+        with unit_of_work(session) as scope:
+            mark_marketing_email_sent(user_id, recipient_email, session=scope)
+    except Exception as e:
+        print(f"[Affiliate] Error recording sent_at for {recipient_email}: {e}")
+    
+    return True, "Email sent successfully"
 
 
-def send_all_marketing_emails(user_id, sender_name):
-    """Send marketing emails to all addresses in user's list."""
-    emails = get_marketing_emails(user_id)
+def send_all_marketing_emails(user_id, sender_name, session=None):
+    """
+    Send marketing emails to all addresses in user's list.
+    
+    Returns an empty list if the user's list is empty.
+    """
+    with read_only_session() as read_session:
+        emails = [entry.email for entry in get_marketing_emails(user_id, session=read_session)]
+    if not emails:
+        return []
+    
+    with unit_of_work(session) as scope:
+        affiliate_code = get_or_create_affiliate_link(user_id, session=scope).code
+    
     results = []
-    for entry in emails:
-        success, msg = send_marketing_email_to_address(user_id, entry.email, sender_name)
-        results.append({"email": entry.email, "success": success, "message": msg})
+    for email in emails:
+        success, msg = send_marketing_email_to_address(
+            user_id, email, sender_name, affiliate_code=affiliate_code, session=session
+        )
+        results.append({"email": email, "success": success, "message": msg})
     return results
 
 
-def match_registration_to_affiliate(registered_email, affiliate_code=None):
+def match_registration_to_affiliate(registered_email, affiliate_code=None, session=None):
     """
     Check if a new registration matches an affiliate source.
     Returns (sharer_user_id, source) or (None, None).
     
     Priority: affiliate_code (link) > email list match
     """
+    session = session or db.session
     registered_email = registered_email.lower().strip()
     
     # First, check if came from affiliate link
     if affiliate_code:
-        link = AffiliateLink.query.filter_by(code=affiliate_code).first()
+        link = session.query(AffiliateLink).filter_by(code=affiliate_code).first()
         if link:
             return link.user_id, 'link'
     
     # Then, check email list matches
-    email_entry = AffiliateEmailList.query.filter_by(email=registered_email).first()
+    email_entry = session.query(AffiliateEmailList).filter_by(email=registered_email).first()
     if email_entry:
         return email_entry.user_id, 'email'
     
     return None, None
 
 
-def create_referral(sharer_id, referred_id, source):
+def create_referral(sharer_id, referred_id, source, session=None):
     """Create an affiliate referral record."""
+    session = session or db.session
     # Check if referral already exists for this referred user
-    existing = AffiliateReferral.query.filter_by(referred_id=referred_id).first()
+    existing = session.query(AffiliateReferral).filter_by(referred_id=referred_id).first()
     if existing:
         return existing
     
@@ -195,12 +258,22 @@ def create_referral(sharer_id, referred_id, source):
         referred_id=referred_id,
         source=source
     )
-    db.session.add(referral)
-    db.session.commit()
+    session.add(referral)
+    commit(session)
     return referral
 
 
-def process_email_verified_reward(referred_user_id):
+def _lock_user(user_id, session):
+    """
+    Load a user with SELECT ... FOR UPDATE.
+    
+    Serializes reward processing per sharer, so concurrent rewards can't
+    lose credit updates or race for the same ledger sequence number.
+    """
+    return session.query(User).filter_by(id=user_id).with_for_update().populate_existing().first()
+
+
+def process_email_verified_reward(referred_user_id, session=None):
     """
     Process rewards when a referred user verifies their email.
     - First referral for sharer: PRO upgrade + 1 token
@@ -208,10 +281,12 @@ def process_email_verified_reward(referred_user_id):
     
     Returns (reward_given, reward_type, message) or (False, None, reason)
     """
-    from models import User
+    session = session or db.session
     
-    # Find the referral record
-    referral = AffiliateReferral.query.filter_by(referred_id=referred_user_id).first()
+    # Find (and lock) the referral record
+    referral = session.query(AffiliateReferral).filter_by(
+        referred_id=referred_user_id
+    ).with_for_update().populate_existing().first()
     if not referral:
         return False, None, "No referral record found"
     
@@ -223,13 +298,13 @@ def process_email_verified_reward(referred_user_id):
     referral.email_verified_at = datetime.utcnow()
     
     # Get sharer
-    sharer = User.query.get(referral.sharer_id)
+    sharer = _lock_user(referral.sharer_id, session)
     if not sharer:
-        db.session.commit()
+        commit(session)
         return False, None, "Sharer not found"
     
     # Check if this is the first referral for the sharer
-    verified_referral_count = AffiliateReferral.query.filter_by(
+    verified_referral_count = session.query(AffiliateReferral).filter_by(
         sharer_id=referral.sharer_id,
         email_verified=True
     ).count()
@@ -253,8 +328,9 @@ def process_email_verified_reward(referred_user_id):
             tier_after=sharer.tier,
             referral_id=referral.id
         )
-        db.session.add(reward)
-        db.session.commit()
+        session.add(reward)
+        record_reward(reward, session=session)
+        commit(session)
         
         print(f"[Affiliate] First referral reward: User {sharer.id} upgraded to {sharer.tier} with +1 token")
         return True, 'first_referral_pro', f"Upgraded to PRO and received 1 token"
@@ -271,28 +347,31 @@ def process_email_verified_reward(referred_user_id):
             tier_after=sharer.tier,
             referral_id=referral.id
         )
-        db.session.add(reward)
-        db.session.commit()
+        session.add(reward)
+        record_reward(reward, session=session)
+        commit(session)
         
         print(f"[Affiliate] Referral token reward: User {sharer.id} received +1 token")
         return True, 'referral_token', "Received 1 token"
 
 
-def process_purchase_reward(referred_user_id, plan_type):
+def process_purchase_reward(referred_user_id, plan_type, session=None):
     """
     Process VIP upgrade when a referred user makes a purchase.
     
     Returns (reward_given, message) or (False, reason)
     """
-    from models import User
+    session = session or db.session
     
-    # Find the referral record
-    referral = AffiliateReferral.query.filter_by(referred_id=referred_user_id).first()
+    # Find (and lock) the referral record
+    referral = session.query(AffiliateReferral).filter_by(
+        referred_id=referred_user_id
+    ).with_for_update().populate_existing().first()
     if not referral:
         return False, "No referral record found"
     
     # Check if already rewarded for purchase
-    existing_vip_reward = AffiliateReward.query.filter_by(
+    existing_vip_reward = session.query(AffiliateReward).filter_by(
         referral_id=referral.id,
         reward_type='vip_upgrade'
     ).first()
@@ -304,9 +383,9 @@ def process_purchase_reward(referred_user_id, plan_type):
     referral.purchase_at = datetime.utcnow()
     
     # Get sharer
-    sharer = User.query.get(referral.sharer_id)
+    sharer = _lock_user(referral.sharer_id, session)
     if not sharer:
-        db.session.commit()
+        commit(session)
         return False, "Sharer not found"
     
     tier_before = sharer.tier
@@ -323,19 +402,30 @@ def process_purchase_reward(referred_user_id, plan_type):
             tier_after='VIP',
             referral_id=referral.id
         )
-        db.session.add(reward)
-        db.session.commit()
+        session.add(reward)
+        record_reward(reward, session=session)
+        commit(session)
         
         print(f"[Affiliate] VIP upgrade reward: User {sharer.id} upgraded to VIP")
         return True, "Upgraded to VIP"
     
-    db.session.commit()
+    commit(session)
     return False, "Sharer already VIP"
 
 
-def get_affiliate_stats(user_id):
-    """Get affiliate dashboard statistics for a user."""
-    link = AffiliateLink.query.filter_by(user_id=user_id).first()
+# How many of the latest rewards the dashboard lists
+RECENT_REWARDS_LIMIT = 20
+
+
+def get_affiliate_stats(user_id, rewards_limit=RECENT_REWARDS_LIMIT, session=None):
+    """
+    Get affiliate dashboard statistics for a user.
+
+    `rewards` lists only the latest `rewards_limit` rewards, newest first, so
+    the dashboard stays cheap for sharers with many rewards.
+    """
+    session = session or db.session
+    link = session.query(AffiliateLink).filter_by(user_id=user_id).first()
     
     stats = {
         'affiliate_code': link.code if link else None,
@@ -349,17 +439,21 @@ def get_affiliate_stats(user_id):
     }
     
     if link:
-        stats['total_visits'] = AffiliateVisit.query.filter_by(affiliate_link_id=link.id).count()
+        stats['total_visits'] = count_link_visits(link.id, session=session)
     
-    stats['total_emails'] = AffiliateEmailList.query.filter_by(user_id=user_id).count()
+    stats['total_emails'] = session.query(AffiliateEmailList).filter_by(user_id=user_id).count()
     
-    referrals = AffiliateReferral.query.filter_by(sharer_id=user_id).all()
+    referrals = session.query(AffiliateReferral).filter_by(sharer_id=user_id).all()
     stats['total_referrals'] = len(referrals)
     stats['verified_referrals'] = sum(1 for r in referrals if r.email_verified)
     stats['purchase_referrals'] = sum(1 for r in referrals if r.purchase_tier)
     
-    rewards = AffiliateReward.query.filter_by(user_id=user_id).all()
-    stats['total_tokens_earned'] = sum(r.tokens_awarded for r in rewards)
+    stats['total_tokens_earned'] = get_balance(user_id, session=session)
+    
+    rewards = session.query(AffiliateReward).filter_by(user_id=user_id).order_by(
+        AffiliateReward.created_at.desc(),
+        AffiliateReward.id.desc()
+    ).limit(rewards_limit).all()
     stats['rewards'] = [
         {
             'type': r.reward_type,
@@ -374,17 +468,17 @@ def get_affiliate_stats(user_id):
     return stats
 
 
-def get_referral_history(user_id):
+def get_referral_history(user_id, session=None):
     """Get detailed referral history for a user."""
-    from models import User
+    session = session or db.session
     
-    referrals = AffiliateReferral.query.filter_by(sharer_id=user_id).order_by(
+    referrals = session.query(AffiliateReferral).filter_by(sharer_id=user_id).order_by(
         AffiliateReferral.created_at.desc()
     ).all()
     
     history = []
     for r in referrals:
-        referred_user = User.query.get(r.referred_id)
+        referred_user = session.get(User, r.referred_id)
         history.append({
             'id': r.id,
             'referred_email': referred_user.email if referred_user else 'Unknown',
@@ -0,0 +1,282 @@
+"""Affiliate system transaction scopes and connection pool metrics.
+
+Services never decide on their own when to commit. They call `commit()`,
+which only commits when no unit of work is open and otherwise flushes so the
+enclosing scope can commit (or roll back) everything at once:
+
+- unit_of_work: Opened by routes, commits exactly once on exit
+- joined_transaction: Opened by hooks, flushes but leaves the commit to the host
+- read_only_session: Opened by read-only routes, read-only transaction on the
+  read replica if configured, else a read-only savepoint on the request's
+  own connection
+"""
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import event, exc, text
+from sqlalchemy.orm import Session
+from extensions import db
+
+# Key in Session.info tracking how many affiliate scopes are open on a session
+_DEPTH_KEY = 'affiliate_uow_depth'
+
+# Key in the pool's connection record info holding the checkout timestamp
+_CHECKOUT_KEY = 'affiliate_checked_out_at'
+
+
+class PoolMetrics:
+    """Thread-safe counters for connection pool usage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checked_out = 0
+            self.checked_out_seconds_total = 0.0
+            self.checked_out_seconds_max = 0.0
+            self.acquires = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+            self.timeouts = 0
+            self.commits = 0
+            self.rollbacks = 0
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def record_checkin(self, held_seconds):
+        with self._lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+            self.checked_out_seconds_total += held_seconds
+            self.checked_out_seconds_max = max(self.checked_out_seconds_max, held_seconds)
+
+    def record_wait(self, wait_seconds, timed_out=False):
+        with self._lock:
+            self.acquires += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def record_commit(self):
+        with self._lock:
+            self.commits += 1
+
+    def record_rollback(self):
+        with self._lock:
+            self.rollbacks += 1
+
+    def snapshot(self):
+        """Return the current counters as a plain dict."""
+        with self._lock:
+            checkins = self.checkouts - self.checked_out
+            return {
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'checked_out_seconds_total': self.checked_out_seconds_total,
+                'checked_out_seconds_avg': self.checked_out_seconds_total / checkins if checkins else 0.0,
+                'checked_out_seconds_max': self.checked_out_seconds_max,
+                'acquires': self.acquires,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_avg': self.wait_seconds_total / self.acquires if self.acquires else 0.0,
+                'wait_seconds_max': self.wait_seconds_max,
+                'timeouts': self.timeouts,
+                'commits': self.commits,
+                'rollbacks': self.rollbacks
+            }
+
+
+pool_metrics = PoolMetrics()
+
+# Exported as Prometheus metrics: snapshot key -> (name, type, help)
+_PROMETHEUS_METRICS = {
+    'checkouts': ('affiliate_pool_checkouts_total', 'counter', 'Connections checked out of the pool'),
+    'checked_out': ('affiliate_pool_checked_out', 'gauge', 'Connections currently checked out'),
+    'checked_out_seconds_total': ('affiliate_pool_checked_out_seconds_total', 'counter', 'Time connections spent checked out'),
+    'checked_out_seconds_max': ('affiliate_pool_checked_out_seconds_max', 'gauge', 'Longest time a connection was checked out'),
+    'acquires': ('affiliate_pool_acquires_total', 'counter', 'Connection requests made to the pool'),
+    'wait_seconds_total': ('affiliate_pool_wait_seconds_total', 'counter', 'Time spent waiting for a pooled connection'),
+    'wait_seconds_max': ('affiliate_pool_wait_seconds_max', 'gauge', 'Longest wait for a pooled connection'),
+    'timeouts': ('affiliate_pool_timeouts_total', 'counter', 'Connection requests that hit pool_timeout'),
+    'commits': ('affiliate_commits_total', 'counter', 'Transactions committed by affiliate scopes'),
+    'rollbacks': ('affiliate_rollbacks_total', 'counter', 'Transactions rolled back by affiliate scopes'),
+}
+
+_instrument_lock = threading.Lock()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info[_CHECKOUT_KEY] = time.perf_counter()
+    pool_metrics.record_checkout()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    checked_out_at = connection_record.info.pop(_CHECKOUT_KEY, None)
+    if checked_out_at is not None:
+        pool_metrics.record_checkin(time.perf_counter() - checked_out_at)
+
+
+def _timed_do_get(do_get):
+    """Wrap a pool's _do_get, which is where a checkout blocks until a connection is free."""
+    def timed():
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - started, timed_out)
+    return timed
+
+
+def instrument_engine(engine):
+    """
+    Attach pool metrics to an engine's current pool (idempotent).
+
+    Checkout/checkin events give the checked-out time; the wait is timed
+    around the pool's own _do_get, so it covers every checkout (including
+    the one loading `g.user`), not just affiliate scopes. Call again after
+    engine.dispose(), which replaces the pool.
+    """
+    pool = engine.pool
+    with _instrument_lock:
+        if getattr(pool, '_affiliate_instrumented', False):
+            return
+        event.listen(pool, 'checkout', _on_checkout)
+        event.listen(pool, 'checkin', _on_checkin)
+        pool._do_get = _timed_do_get(pool._do_get)
+        pool._affiliate_instrumented = True
+
+
+def instrument_all_engines():
+    """Instrument every engine Flask-SQLAlchemy manages for the current app."""
+    for engine in db.engines.values():
+        instrument_engine(engine)
+
+
+def get_pool_metrics():
+    """Get pool usage metrics (checked-out time, wait time, commits) for export."""
+    return pool_metrics.snapshot()
+
+
+def render_prometheus_metrics():
+    """Pool metrics in the Prometheus text exposition format."""
+    snapshot = get_pool_metrics()
+    lines = []
+    for key, (name, metric_type, description) in _PROMETHEUS_METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {snapshot[key]}")
+    return '\n'.join(lines) + '\n'
+
+
+def in_transaction_scope(session=None):
+    """Whether an affiliate unit of work is currently open on the session."""
+    session = session or db.session
+    return session.info.get(_DEPTH_KEY, 0) > 0
+
+
+def commit(session=None):
+    """
+    Commit the session unless a unit of work is open.
+
+    Inside a unit of work this only flushes, so generated ids are available
+    and the enclosing scope decides whether the work is committed.
+    """
+    session = session or db.session
+    if in_transaction_scope(session):
+        session.flush()
+    else:
+        session.commit()
+        pool_metrics.record_commit()
+
+
+@contextmanager
+def unit_of_work(session=None):
+    """
+    Run a block in a single transaction.
+
+    The outermost scope commits on success and rolls back on error; nested
+    scopes join the outer transaction.
+
+    Yields:
+        The session to pass to services
+    """
+    session = session or db.session
+    depth = session.info.get(_DEPTH_KEY, 0)
+    if depth == 0:
+        instrument_engine(session.get_bind())
+    session.info[_DEPTH_KEY] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+            pool_metrics.record_commit()
+    except Exception:
+        if depth == 0:
+            session.rollback()
+            pool_metrics.record_rollback()
+        raise
+    finally:
+        session.info[_DEPTH_KEY] = depth
+
+
+@contextmanager
+def joined_transaction(session=None):
+    """
+    Join a transaction owned by the caller (e.g. the host app's registration flow).
+
+    Services only flush; committing or rolling back is left to the host.
+    """
+    session = session or db.session
+    depth = session.info.get(_DEPTH_KEY, 0)
+    session.info[_DEPTH_KEY] = depth + 1
+    try:
+        yield session
+    finally:
+        session.info[_DEPTH_KEY] = depth
+
+
+@contextmanager
+def read_only_session():
+    """
+    Open a read-only session for read-only endpoints.
+
+    With an `AFFILIATE_READ_BIND` bind (e.g. a read replica) configured, a
+    separate session reads from it in its own read-only transaction, using
+    that bind's own pool. Otherwise the request's `db.session` connection is
+    reused (it usually already holds one, e.g. from loading `g.user`) and the
+    reads run in a SAVEPOINT made read-only, so no second connection is
+    taken from the primary pool. Either way nothing read here is committed.
+    """
+    bind_key = current_app.config.get('AFFILIATE_READ_BIND')
+    if bind_key and bind_key in db.engines:
+        engine = db.engines[bind_key]
+        instrument_engine(engine)
+        session = Session(bind=engine)
+        try:
+            if engine.dialect.name == 'postgresql':
+                session.execute(text('SET TRANSACTION READ ONLY'))
+            yield session
+        finally:
+            session.rollback()
+            session.close()
+        return
+
+    session = db.session
+    savepoint = session.begin_nested()
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            # Only lasts until the savepoint is rolled back
+            session.execute(text('SET TRANSACTION READ ONLY'))
+        yield session
+    finally:
+        savepoint.rollback()
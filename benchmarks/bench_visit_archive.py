@@ -0,0 +1,136 @@
+"""Benchmark: affiliate_visit rows vs the columnar visit archive.
+
+Generates one month of synthetic visits for a single link and compares:
+
+- bytes per visit: SQLite table with the affiliate_visit schema (the "before"
+  row store, runnable anywhere) plus an estimate of the PostgreSQL heap size,
+  against the archive file produced by archive_format.py
+- scan speed: counting a time window and decoding every visit
+
+Usage:
+    python benchmarks/bench_visit_archive.py [--visits N] [--user-agents N]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from archive_format import VisitArchiveFile, write_visit_file  # noqa: E402
+
+UA_TEMPLATES = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/{v}.1 Safari/605.1.15",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_{v} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 Instagram 312.0.0.{v}",
+    "Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.6099.144 Mobile Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:{v}.0) Gecko/20100101 Firefox/{v}.0",
+]
+
+
+def generate_visits(count, distinct_user_agents, seed=42):
+    rng = random.Random(seed)
+    user_agents = [UA_TEMPLATES[i % len(UA_TEMPLATES)].format(v=100 + i) for i in range(distinct_user_agents)]
+    start = datetime(2025, 1, 1)
+    month_seconds = 31 * 86400
+    visits = []
+    for _ in range(count):
+        visited_at = start + timedelta(microseconds=rng.randrange(month_seconds * 1000000))
+        if rng.random() < 0.8:
+            ip = '.'.join(str(rng.randrange(1, 255)) for _ in range(4))
+        else:
+            ip = '2001:db8:%x:%x::%x' % (rng.randrange(65536), rng.randrange(65536), rng.randrange(65536))
+        visits.append((visited_at, ip, rng.choice(user_agents)))
+    visits.sort()
+    return visits
+
+
+def postgres_heap_bytes(visits):
+    """Rough affiliate_visit heap size: tuple header, line pointer, columns, alignment."""
+    total = 0
+    for _, ip, user_agent in visits:
+        ua_len = len(user_agent.encode('utf-8'))
+        row = 24 + 4  # HeapTupleHeader + line pointer
+        row += 4 + 4  # id, affiliate_link_id
+        row += 1 + len(ip)  # short varlena
+        row += (1 if ua_len < 127 else 4) + ua_len
+        row = (row + 7) // 8 * 8 + 8  # align, then timestamp
+        total += row
+    return total
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--visits', type=int, default=200000)
+    parser.add_argument('--user-agents', type=int, default=200)
+    args = parser.parse_args()
+
+    visits = generate_visits(args.visits, args.user_agents)
+    window_start = datetime(2025, 1, 10)
+    window_end = datetime(2025, 1, 17)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'visits.sqlite')
+        conn = sqlite3.connect(db_path)
+        conn.execute(
+            "CREATE TABLE affiliate_visit (id INTEGER PRIMARY KEY, visitor_ip VARCHAR(45), "
+            "user_agent VARCHAR(512), visited_at TIMESTAMP, affiliate_link_id INTEGER NOT NULL)"
+        )
+        conn.executemany(
+            "INSERT INTO affiliate_visit (visitor_ip, user_agent, visited_at, affiliate_link_id) VALUES (?, ?, ?, 1)",
+            [(ip, ua, at.isoformat(' ')) for at, ip, ua in visits]
+        )
+        conn.commit()
+        conn.execute("VACUUM")
+        sqlite_bytes = os.path.getsize(db_path)
+
+        row_window, row_window_s = timed(lambda: conn.execute(
+            "SELECT COUNT(*) FROM affiliate_visit WHERE affiliate_link_id = 1 AND visited_at >= ? AND visited_at < ?",
+            (window_start.isoformat(' '), window_end.isoformat(' '))
+        ).fetchone()[0])
+        row_count, row_count_s = timed(lambda: conn.execute(
+            "SELECT COUNT(*) FROM affiliate_visit WHERE affiliate_link_id = 1"
+        ).fetchone()[0])
+        row_rows, row_scan_s = timed(lambda: sum(1 for _ in conn.execute(
+            "SELECT visited_at, visitor_ip, user_agent FROM affiliate_visit WHERE affiliate_link_id = 1"
+        )))
+        conn.close()
+
+        archive_path = os.path.join(tmp, 'link_1', '2025-01.afv')
+        _, encode_s = timed(lambda: write_visit_file(archive_path, [(i, *visit) for i, visit in enumerate(visits, 1)]))
+        archive_bytes = os.path.getsize(archive_path)
+
+        with VisitArchiveFile(archive_path) as archive:
+            _, count_s = timed(lambda: archive.count)
+            archive_window, archive_window_s = timed(lambda: archive.count_between(window_start, window_end))
+            archive_rows, archive_scan_s = timed(lambda: sum(1 for _ in archive))
+
+    assert row_window == archive_window and row_count == row_rows == archive_rows == len(visits)
+
+    n = len(visits)
+    print(f"visits: {n}, distinct user agents: {args.user_agents}")
+    print()
+    print("bytes per visit")
+    print(f"  postgres heap (est.)   {postgres_heap_bytes(visits) / n:8.1f}")
+    print(f"  sqlite row table       {sqlite_bytes / n:8.1f}")
+    print(f"  columnar archive       {archive_bytes / n:8.1f}")
+    print()
+    print("scan (seconds)")
+    print(f"  total count            row {row_count_s:8.4f}   archive {count_s:8.6f} (header only)")
+    print(f"  7-day window count     row {row_window_s:8.4f}   archive {archive_window_s:8.4f}")
+    print(f"  full decode            row {row_scan_s:8.4f}   archive {archive_scan_s:8.4f}")
+    print(f"  archive encode         {encode_s:8.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark and budget check for the affiliate package's import time.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter (so
+nothing is cached) from the host project root, reports the slowest imports
+and fails if the module's cumulative import time exceeds the budget.
+
+Run it from the host project (where `extensions.py`, `models.py` and the
+`affiliate/` package live):
+
+    python path/to/check_import_time.py                       # import affiliate
+    python path/to/check_import_time.py -m affiliate.hooks --budget-ms 700
+    python path/to/check_import_time.py --repeat 5 --top 15
+
+Exits with status 1 when the median cumulative time is over budget, so it
+can run as a CI step.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# Budgets (ms, median cumulative) for the entry points we care about, set
+# from benchmarks/results/import_time.txt with headroom for noisy CI runners.
+# affiliate.hooks is dominated by Flask and SQLAlchemy (~85%), which the
+# host's models need anyway.
+DEFAULT_BUDGETS_MS = {
+    'affiliate': 10,
+    'affiliate.hooks': 700,
+}
+
+# Modules each entry point is expected to leave unimported
+LAZY_MODULES = {
+    'affiliate': ('flask', 'sqlalchemy', 'affiliate.routes', 'affiliate.services', 'resend'),
+    'affiliate.hooks': ('affiliate.routes', 'resend'),
+}
+
+_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure(module, cwd):
+    """Import `module` in a fresh interpreter; return {name: (self_us, cumulative_us)}."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=cwd,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f"Importing {module} failed")
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, _, name = match.groups()
+            timings[name] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-m', '--module', default='affiliate')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='Default: %s' % ', '.join(f'{m}={b}' for m, b in DEFAULT_BUDGETS_MS.items()))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--cwd', default=os.getcwd(), help='Host project root')
+    args = parser.parse_args()
+
+    budget_ms = args.budget_ms if args.budget_ms is not None else DEFAULT_BUDGETS_MS.get(args.module)
+
+    runs = [measure(args.module, args.cwd) for _ in range(args.repeat)]
+    totals_ms = [run[args.module][1] / 1000 for run in runs]
+    median_ms = statistics.median(totals_ms)
+
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+    print(f"python -X importtime -c 'import {args.module}' ({args.repeat} runs)")
+    print(f"  cumulative: median {median_ms:.1f} ms, min {min(totals_ms):.1f} ms, max {max(totals_ms):.1f} ms")
+    print("  slowest imports (self time, last run):")
+    for name, (self_us, cumulative_us) in slowest:
+        print(f"    {self_us / 1000:8.2f} ms  (cumulative {cumulative_us / 1000:8.2f} ms)  {name}")
+
+    heavy = [name for name in LAZY_MODULES.get(args.module, ()) if name in runs[-1]]
+    if heavy:
+        print(f"  note: imported eagerly: {', '.join(heavy)}")
+
+    if budget_ms is None:
+        return 0
+    if median_ms > budget_ms:
+        print(f"FAIL: {args.module} imports in {median_ms:.1f} ms, budget is {budget_ms} ms")
+        return 1
+    print(f"OK: {args.module} imports in {median_ms:.1f} ms, budget is {budget_ms} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+-- ============================================
+-- Convert affiliate_visit to monthly range partitions
+-- ============================================
+-- For databases created from schema.sql before the table was partitioned.
+-- Copies all rows into a partitioned table with the same name and ids, and
+-- keeps the old table as affiliate_visit_unpartitioned until you drop it.
+-- Run during a quiet period: the old table is locked while rows are copied.
+
+BEGIN;
+
+ALTER TABLE affiliate_visit RENAME TO affiliate_visit_unpartitioned;
+ALTER TABLE affiliate_visit_unpartitioned RENAME CONSTRAINT affiliate_visit_pkey TO affiliate_visit_unpartitioned_pkey;
+
+-- Free the index names for the partitioned table (a newer schema.sql run
+-- against the old table, or db.create_all(), may have created them)
+ALTER INDEX IF EXISTS ix_affiliate_visit_link_visited RENAME TO ix_affiliate_visit_unpartitioned_link_visited;
+ALTER INDEX IF EXISTS ix_affiliate_visit_link_ip_visited RENAME TO ix_affiliate_visit_unpartitioned_link_ip_visited;
+
+-- Reuse the existing SERIAL sequence so ids keep increasing
+CREATE TABLE affiliate_visit (
+    id INTEGER NOT NULL DEFAULT nextval('affiliate_visit_id_seq'),
+    visitor_ip VARCHAR(45),
+    user_agent VARCHAR(512),
+    visited_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    affiliate_link_id INTEGER NOT NULL REFERENCES affiliate_link(id),
+    PRIMARY KEY (id, visited_at)
+) PARTITION BY RANGE (visited_at);
+ALTER SEQUENCE affiliate_visit_id_seq OWNED BY affiliate_visit.id;
+
+CREATE INDEX ix_affiliate_visit_link_visited ON affiliate_visit (affiliate_link_id, visited_at);
+CREATE INDEX ix_affiliate_visit_link_ip_visited ON affiliate_visit (affiliate_link_id, visitor_ip, visited_at);
+
+-- One partition per month from the oldest existing row to 3 months ahead, plus a DEFAULT partition
+DO $$
+DECLARE
+    first_month DATE;
+    month_start DATE;
+BEGIN
+    SELECT date_trunc('month', MIN(visited_at)) INTO first_month FROM affiliate_visit_unpartitioned;
+    FOR month_start IN
+        SELECT generate_series(
+            LEAST(COALESCE(first_month, date_trunc('month', NOW())), date_trunc('month', NOW())),
+            date_trunc('month', NOW()) + INTERVAL '3 months',
+            INTERVAL '1 month'
+        )::DATE
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF affiliate_visit FOR VALUES FROM (%L) TO (%L)',
+            'affiliate_visit_' || to_char(month_start, 'YYYY_MM'),
+            month_start, (month_start + INTERVAL '1 month')::DATE
+        );
+    END LOOP;
+    CREATE TABLE IF NOT EXISTS affiliate_visit_default PARTITION OF affiliate_visit DEFAULT;
+END $$;
+
+-- Rows without a timestamp (possible before NOT NULL) are filed under NOW()
+INSERT INTO affiliate_visit (id, visitor_ip, user_agent, visited_at, affiliate_link_id)
+SELECT id, visitor_ip, user_agent, COALESCE(visited_at, NOW()), affiliate_link_id
+FROM affiliate_visit_unpartitioned;
+
+-- affiliate_reward stays a plain table; it only gains the lookup indexes
+CREATE INDEX IF NOT EXISTS ix_affiliate_reward_user_created ON affiliate_reward (user_id, created_at);
+CREATE INDEX IF NOT EXISTS ix_affiliate_reward_referral_created ON affiliate_reward (referral_id, created_at);
+
+COMMIT;
+
+-- After checking the row counts match:
+-- DROP TABLE affiliate_visit_unpartitioned;
@@ -10,14 +10,15 @@ CREATE TABLE IF NOT EXISTS affiliate_link (
     created_at TIMESTAMP DEFAULT NOW()
 );
 
--- 16. Create AffiliateVisit table
+-- 16. Create AffiliateVisit table (partitioned by month, see 19b)
 CREATE TABLE IF NOT EXISTS affiliate_visit (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     visitor_ip VARCHAR(45),
     user_agent VARCHAR(512),
-    visited_at TIMESTAMP DEFAULT NOW(),
-    affiliate_link_id INTEGER NOT NULL REFERENCES affiliate_link(id)
-);
+    visited_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    affiliate_link_id INTEGER NOT NULL REFERENCES affiliate_link(id),
+    PRIMARY KEY (id, visited_at)
+) PARTITION BY RANGE (visited_at);
 
 -- 17. Create AffiliateEmailList table
 CREATE TABLE IF NOT EXISTS affiliate_email_list (
@@ -53,3 +54,82 @@ CREATE TABLE IF NOT EXISTS affiliate_reward (
     referral_id INTEGER REFERENCES affiliate_referral(id),
     created_at TIMESTAMP DEFAULT NOW()
 );
+
+CREATE INDEX IF NOT EXISTS ix_affiliate_reward_user_created ON affiliate_reward (user_id, created_at);
+CREATE INDEX IF NOT EXISTS ix_affiliate_reward_referral_created ON affiliate_reward (referral_id, created_at);
+
+-- 19b. affiliate_visit indexes, monthly partitions for the current month and the
+-- next 3, plus a DEFAULT partition so inserts never fail if a month is missing.
+-- Afterwards `flask affiliate maintain-partitions` keeps future months created.
+DO $$
+DECLARE
+    month_start DATE;
+BEGIN
+    -- Table created before partitioning: see migrations/001_partition_visit.sql
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'affiliate_visit'::regclass) THEN
+        RETURN;
+    END IF;
+    -- Only created here so the migration can still claim these names
+    CREATE INDEX IF NOT EXISTS ix_affiliate_visit_link_visited ON affiliate_visit (affiliate_link_id, visited_at);
+    CREATE INDEX IF NOT EXISTS ix_affiliate_visit_link_ip_visited ON affiliate_visit (affiliate_link_id, visitor_ip, visited_at);
+    FOR month_start IN
+        SELECT generate_series(date_trunc('month', NOW()), date_trunc('month', NOW()) + INTERVAL '3 months', INTERVAL '1 month')::DATE
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF affiliate_visit FOR VALUES FROM (%L) TO (%L)',
+            'affiliate_visit_' || to_char(month_start, 'YYYY_MM'),
+            month_start, (month_start + INTERVAL '1 month')::DATE
+        );
+    END LOOP;
+    CREATE TABLE IF NOT EXISTS affiliate_visit_default PARTITION OF affiliate_visit DEFAULT;
+END $$;
+
+-- 20. Create AffiliateLedgerEntry table (append-only)
+CREATE TABLE IF NOT EXISTS affiliate_ledger_entry (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES "user"(id),
+    sequence INTEGER NOT NULL,
+    entry_type VARCHAR(30) NOT NULL,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    reward_id INTEGER REFERENCES affiliate_reward(id),
+    created_at TIMESTAMP DEFAULT NOW(),
+    CONSTRAINT uix_affiliate_ledger_user_seq UNIQUE (user_id, sequence)
+);
+
+CREATE OR REPLACE FUNCTION affiliate_ledger_reject_change() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'affiliate_ledger_entry is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS affiliate_ledger_append_only ON affiliate_ledger_entry;
+CREATE TRIGGER affiliate_ledger_append_only
+    BEFORE UPDATE OR DELETE ON affiliate_ledger_entry
+    FOR EACH ROW EXECUTE FUNCTION affiliate_ledger_reject_change();
+
+-- 21. Create AffiliateBalanceSnapshot table
+CREATE TABLE IF NOT EXISTS affiliate_balance_snapshot (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES "user"(id),
+    sequence INTEGER NOT NULL,
+    balance INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW(),
+    CONSTRAINT uix_affiliate_snapshot_user_seq UNIQUE (user_id, sequence)
+);
+
+-- 22. Backfill the ledger from existing rewards (only runs on an empty ledger)
+INSERT INTO affiliate_ledger_entry (user_id, sequence, entry_type, tokens, reward_id, created_at)
+SELECT user_id,
+       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at, id),
+       reward_type,
+       COALESCE(tokens_awarded, 0),
+       id,
+       created_at
+FROM affiliate_reward
+WHERE NOT EXISTS (SELECT 1 FROM affiliate_ledger_entry);
+
+INSERT INTO affiliate_balance_snapshot (user_id, sequence, balance)
+SELECT user_id, MAX(sequence), SUM(tokens)
+FROM affiliate_ledger_entry
+WHERE NOT EXISTS (SELECT 1 FROM affiliate_balance_snapshot)
+GROUP BY user_id;